@@ -0,0 +1,460 @@
+# Collects the results of several testing stations running the task in parallel
+# Each station streams its trials to the collector over a socket and
+# the collector saves them under consts.collector_dir (never in the station's own consts.raw_dir)
+
+# import libraries
+import json
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import random
+from pathlib import Path
+import pandas as pd
+
+import constants as consts
+
+# default address of the collector
+## use the ip of the collector PC when the stations are on different PCs
+host = 'localhost'
+port = 5005
+
+def _to_json(value):
+    """
+    converts numpy values into values that can be written as json
+    """
+    if hasattr(value, 'tolist'): # numpy arrays and scalars
+        return value.tolist()
+    return str(value)
+
+class CohortStore():
+    """
+    Keeps the trials sent by all the stations
+    Trials are kept once for each subject/run/trial (TN), so resending a trial does not duplicate it
+    Args:
+        study_name : either 'behavioural' or 'fmri'
+        output_dir : directory the trials are saved in (DEFAULT: consts.collector_dir)
+                     it is kept apart from consts.raw_dir so the collector never rewrites
+                     the file saved by a station running on the same PC
+    """
+    def __init__(self, study_name = 'behavioural', output_dir = None):
+        self.study_name = study_name
+        self.output_dir = consts.collector_dir if output_dir is None else output_dir
+        self.trials     = {} # a dictionary with {subject_id: {(run_number, TN): record}}
+        self.lock       = threading.Lock()
+
+    def get_subject_file(self, subject_id):
+        """
+        path to the result file of the subject (same layout as Run.get_run_results, under output_dir)
+        """
+        return Path(self.output_dir) / self.study_name / 'raw' / subject_id / f"WMC_{subject_id}.csv"
+
+    def _load_subject(self, subject_id):
+        """
+        loads the trials already saved for the subject (from previous sessions)
+        """
+        self.trials[subject_id] = {}
+        subject_file = self.get_subject_file(subject_id)
+        if subject_file.is_file():
+            df = pd.read_csv(subject_file)
+            if 'TN' in df.columns:
+                for record in df.to_dict('records'):
+                    self.trials[subject_id][(record['run_number'], record['TN'])] = record
+
+    def add_batch(self, records):
+        """
+        adds a batch of trials to the store
+        Args:
+            records : list of trial records (dictionaries)
+        Returns:
+            subjects (set) : subjects with at least one new trial
+        """
+        subjects = set()
+        with self.lock:
+            for record in records:
+                subject_id = record['subject_id']
+                if subject_id not in self.trials:
+                    self._load_subject(subject_id)
+
+                key = (record['run_number'], record['TN'])
+                if key in self.trials[subject_id]: # already received (station reconnected and resent)
+                    continue
+                self.trials[subject_id][key] = record
+                subjects.add(subject_id)
+        return subjects
+
+    def save_subject(self, subject_id):
+        """
+        saves all the trials of the subject into WMC_<subject_id>.csv
+        """
+        with self.lock:
+            records = [self.trials[subject_id][key] for key in sorted(self.trials[subject_id])]
+
+        subject_file = self.get_subject_file(subject_id)
+        consts.dircheck(subject_file.parent)
+
+        df = pd.DataFrame(records).drop(columns = ['subject_id'], errors = 'ignore')
+        df.to_csv(subject_file, index = False)
+
+class _StationHandler(socketserver.StreamRequestHandler):
+    """
+    handles the connection of one station
+    messages are json objects, one per line:
+        {'type': 'hello', 'station': ..., 'subject_id': ..., 'run_number': ..., 'num_trials': ...}
+        {'type': 'trial', 'station': ..., 'record': {...}}
+        {'type': 'status'}
+    every message is answered with one line of json
+    """
+    def handle(self):
+        collector = self.server.collector
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            reply = collector.handle_message(message)
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+
+class _ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads      = True
+
+class Collector():
+    """
+    A local server the stations stream their trials to
+    Trials are put in a queue and saved in batches, so a station never waits for the disk
+    Args:
+        host           : address the collector listens on
+        port           : port the collector listens on
+        study_name     : either 'behavioural' or 'fmri'
+        flush_interval : time (in seconds) between two batches saved to the disk
+        output_dir     : directory the trials are saved in (DEFAULT: consts.collector_dir)
+    """
+    def __init__(self, host = host, port = port,
+                 study_name = 'behavioural', flush_interval = 1, output_dir = None):
+
+        self.address        = (host, port)
+        self.flush_interval = flush_interval
+        self.store          = CohortStore(study_name = study_name, output_dir = output_dir)
+        self.trial_queue    = queue.Queue()
+        self.dirty_subjects = set() # subjects with trials not saved yet
+        self.progress       = {} # a dictionary with the progress of each station
+        self.progress_lock  = threading.Lock()
+        self.is_running     = False
+
+    def handle_message(self, message):
+        """
+        handles a message sent by a station and returns the reply
+        """
+        if message['type'] == 'hello':
+            with self.progress_lock:
+                station = self.progress.get(message['station'])
+                # a station reconnecting during the same run keeps its progress
+                if (station is None or station['subject_id'] != message['subject_id']
+                        or station['run_number'] != message['run_number']):
+                    self.progress[message['station']] = {'subject_id' : message['subject_id'],
+                                                         'run_number' : message['run_number'],
+                                                         'num_trials' : message['num_trials'],
+                                                         'trials'     : set(),
+                                                         'last_trial' : None,
+                                                         'last_seen'  : time.time()}
+                else:
+                    station['last_seen'] = time.time()
+            return {'ok': True}
+
+        elif message['type'] == 'trial':
+            record = message['record']
+            self.trial_queue.put(record)
+            with self.progress_lock:
+                station = self.progress.get(message['station'])
+                if station is not None:
+                    station['trials'].add(record['TN'])
+                    station['last_trial'] = record['TN']
+                    station['last_seen']  = time.time()
+            return {'ok': True, 'TN': record['TN']}
+
+        elif message['type'] == 'status':
+            return {'ok': True, 'progress': self.get_progress()}
+
+        return {'ok': False, 'error': f"unknown message type {message['type']}"}
+
+    def get_progress(self):
+        """
+        returns the progress of all the stations
+        """
+        progress = {}
+        with self.progress_lock:
+            for station, info in self.progress.items():
+                progress[station] = {key: value for key, value in info.items() if key != 'trials'}
+                progress[station]['trials_done'] = len(info['trials'])
+        return progress
+
+    def flush(self):
+        """
+        saves all the trials waiting in the queue
+        """
+        records = []
+        while True:
+            try:
+                records.append(self.trial_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if len(records) > 0:
+            try:
+                self.dirty_subjects |= self.store.add_batch(records)
+            except Exception as e:
+                # put the trials back, they are added with the next batch
+                print(f"could not add the trials to the store: {type(e).__name__}: {e}")
+                for record in records:
+                    self.trial_queue.put(record)
+                return
+
+        # a subject that can not be saved (e.g. the file is locked by OneDrive or Excel)
+        ## stays dirty and is saved again with the next batch
+        for subject_id in list(self.dirty_subjects):
+            try:
+                self.store.save_subject(subject_id)
+                self.dirty_subjects.discard(subject_id)
+            except Exception as e:
+                print(f"could not save {subject_id}, trying again: {type(e).__name__}: {e}")
+
+    def _flush_loop(self):
+        """
+        saves the trials in batches while the collector is running
+        """
+        while self.is_running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        """
+        starts the collector in the background
+        """
+        self.server = _ThreadingServer(self.address, _StationHandler)
+        self.server.collector = self
+        self.address = self.server.server_address # the actual port if port 0 was used
+
+        self.is_running = True
+        self.server_thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.flush_thread  = threading.Thread(target = self._flush_loop, daemon = True)
+        self.server_thread.start()
+        self.flush_thread.start()
+        print(f"collector listening on {self.address[0]}:{self.address[1]}")
+
+    def stop(self):
+        """
+        stops the collector and saves what is left in the queue
+        """
+        self.is_running = False
+        self.server.shutdown()
+        self.server.server_close()
+        self.flush_thread.join()
+        self.flush()
+
+class StationClient():
+    """
+    Sends the trials of a station to the collector
+    send_trial only puts the trial in a queue: connecting, waiting for the collector and
+    resending after a lost connection are all done by a sender thread, so the task is never blocked
+    Args:
+        station        : name of the station (for example the name of the PC)
+        subject_id     : id of the subject tested on the station
+        run_number     : number of the run
+        num_trials     : number of trials in the run
+        host           : address of the collector
+        port           : port of the collector
+        timeout        : time (in seconds) to wait for the collector before giving up
+        retry_interval : time (in seconds) between two attempts to reach the collector
+    """
+    def __init__(self, station, subject_id, run_number, num_trials,
+                 host = host, port = port, timeout = 0.2, retry_interval = 1):
+
+        self.station        = station
+        self.subject_id     = subject_id
+        self.run_number     = run_number
+        self.num_trials     = num_trials
+        self.address        = (host, port)
+        self.timeout        = timeout
+        self.retry_interval = retry_interval
+        self.sock           = None
+        self.trial_queue    = queue.Queue() # trials waiting to be sent
+        self.pending        = None          # trial being sent, kept until the collector acknowledges it
+        self.is_running     = True
+
+        self.sender_thread = threading.Thread(target = self._send_loop, daemon = True)
+        self.sender_thread.start()
+
+    def _send(self, message):
+        """
+        sends a message and returns the reply of the collector
+        """
+        self.sock.sendall((json.dumps(message, default = _to_json) + '\n').encode())
+        reply = self.rfile.readline()
+        if not reply: # the collector closed the connection
+            raise ConnectionError('connection closed by the collector')
+        return json.loads(reply)
+
+    def _connect(self):
+        """
+        (re)connects to the collector
+        Returns:
+            connected (bool) : whether the station is connected
+        """
+        try:
+            self.sock  = socket.create_connection(self.address, timeout = self.timeout)
+            self.rfile = self.sock.makefile('rb')
+            self._send({'type'       : 'hello',
+                        'station'    : self.station,
+                        'subject_id' : self.subject_id,
+                        'run_number' : self.run_number,
+                        'num_trials' : self.num_trials})
+            return True
+        except (OSError, ValueError):
+            self._disconnect()
+            return False
+
+    def _disconnect(self):
+        """
+        closes the connection (the sender thread reconnects for the next trial)
+        """
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def _send_loop(self):
+        """
+        runs in the sender thread: sends the trials one by one and waits for the collector to acknowledge them
+        a trial is sent again after reconnecting if it was not acknowledged
+        """
+        while True:
+            if self.pending is None:
+                self.pending = self.trial_queue.get()
+                if self.pending is None: # close() was called and all the trials before it were sent
+                    break
+
+            if self.sock is None and not self._connect():
+                if not self.is_running: # closing and the collector can not be reached
+                    break
+                time.sleep(self.retry_interval)
+                continue
+
+            try:
+                self._send({'type': 'trial', 'station': self.station, 'record': self.pending})
+                self.pending = None
+            except (OSError, ValueError):
+                self._disconnect()
+        self._disconnect()
+
+    def send_trial(self, record):
+        """
+        puts a trial in the queue of the sender thread (returns immediately)
+        Args:
+            record : dictionary with the info and responses of the trial
+        """
+        self.trial_queue.put(dict(record, subject_id = self.subject_id))
+
+    def close(self, wait = 5):
+        """
+        waits for the trials in the queue to be sent and stops the sender thread
+        Args:
+            wait : time (in seconds) to wait for the trials to be sent
+        """
+        self.trial_queue.put(None)
+        self.sender_thread.join(timeout = wait)
+
+        # give up on the collector, the trials are still in the station's own file
+        self.is_running = False
+        self.sender_thread.join()
+
+        num_unsent = int(self.pending is not None)
+        while not self.trial_queue.empty():
+            num_unsent += self.trial_queue.get_nowait() is not None
+        if num_unsent > 0:
+            print(f"collector not reachable, {num_unsent} trials not sent")
+
+def get_progress(host = host, port = port):
+    """
+    asks the collector for the progress of all the stations
+    Returns:
+        progress_df (pd.DataFrame) : one row for each station
+    """
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall((json.dumps({'type': 'status'}) + '\n').encode())
+        reply = json.loads(sock.makefile('rb').readline())
+
+    return pd.DataFrame.from_dict(reply['progress'], orient = 'index')
+
+def simulate_station(station, subject_id, host = host, port = port,
+                     run_number = 1, num_trials = 16, trial_dur = 0.01, drop_after = None):
+    """
+    simulates a station running the task (used to test the collector on one PC)
+    Args:
+        station    : name of the simulated station
+        subject_id : id of the simulated subject
+        run_number : number of the run
+        num_trials : number of trials sent by the station
+        trial_dur  : time (in seconds) between two trials
+        drop_after : if given, the connection is dropped after this trial to test reconnecting
+    """
+    client = StationClient(station = station, subject_id = subject_id, run_number = run_number,
+                           num_trials = num_trials, host = host, port = port)
+    for tn in range(num_trials):
+        phase_type = tn % 2
+        response   = [str(random.randint(1, 4)) for i in range(6)] if phase_type == 1 else []
+        record = {'TN'            : tn,
+                  'run_number'    : run_number,
+                  'phase_type'    : phase_type,
+                  'response'      : response,
+                  'response_time' : [0.2*i for i in range(len(response))],
+                  'is_error'      : False,
+                  'points'        : 0}
+        client.send_trial(record)
+
+        if drop_after is not None and tn == drop_after:
+            # cut the connection under the sender thread, it has to reconnect and resend
+            sock = client.sock
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        time.sleep(trial_dur)
+    client.close()
+
+def simulate_stations(num_stations = 4, num_trials = 16, output_dir = None):
+    """
+    runs a collector and several simulated stations on this PC
+    Args:
+        num_stations : number of simulated stations
+        num_trials   : number of trials sent by each station
+        output_dir   : directory the collector saves the simulated trials in
+                       (DEFAULT: a temporary directory, removed at the end)
+    Returns:
+        progress_df (pd.DataFrame) : the progress of all the stations reported by the collector
+    """
+    if output_dir is None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            return simulate_stations(num_stations, num_trials, output_dir = temp_dir)
+
+    collector = Collector(port = 0, study_name = 'simulated', output_dir = output_dir)
+    collector.start()
+    collector_host, collector_port = collector.address
+
+    stations = []
+    for s in range(num_stations):
+        # every other station loses the connection half way through the run
+        drop_after = num_trials // 2 if s % 2 else None
+        stations.append(threading.Thread(target = simulate_station,
+                                         kwargs = {'station'    : f"station{s:02d}",
+                                                   'subject_id' : f"sim{s:02d}",
+                                                   'host'       : collector_host,
+                                                   'port'       : collector_port,
+                                                   'num_trials' : num_trials,
+                                                   'drop_after' : drop_after}))
+    for station in stations:
+        station.start()
+    for station in stations:
+        station.join()
+
+    progress_df = get_progress(collector_host, collector_port)
+    collector.stop()
+    return progress_df
@@ -12,6 +12,8 @@ base_dir   = Path('C:\\Users\\lshah\\OneDrive\\Documents\\Projects').absolute()
 
 target_dir = base_dir / experiment_name /"target_files" # contains target files for the task
 raw_dir    = base_dir/ experiment_name / "data"         # This is where the result files are being saved
+report_dir = base_dir/ experiment_name / "reports"      # This is where the figures and summary tables are saved
+collector_dir = base_dir/ experiment_name / "collector" # This is where the collector saves the trials of all the stations
 
 # setting some defaults for the stimuli presentation
 width_object = 8
@@ -37,6 +39,6 @@ def dirtree():
     Create all the directories if they don't already exist
     """
     
-    fpaths = [raw_dir, target_dir]
+    fpaths = [raw_dir, target_dir, report_dir, collector_dir]
     for fpath in fpaths:
         dircheck(fpath)
\ No newline at end of file
@@ -8,11 +8,16 @@ import numpy as np
 import math
 import glob
 import sys
+import time
+import random
+import tracemalloc
 
 from psychopy import visual, core, event, gui # data, logging
 
 import constants as consts
 from screen import Screen
+from collector import StationClient
+from make_target import AdaptiveWMChunking
 from psychopy.hardware.emulator import launchScan
 from psychopy.hardware import keyboard
 from psychopy import core
@@ -23,7 +28,8 @@ class Run():
     A general class for a run of the task
     """
 
-    def __init__(self, subject_id, screen_number = 1):
+    def __init__(self, subject_id, screen_number = 1, station = None,
+                 collector_host = 'localhost'):
         """
         Args:
             subject_id : id set for the subject. Example: sub-01
@@ -31,9 +37,13 @@ class Run():
             screen_number : number for the subject screen. 
                             Set to 1 when there are multiple monitors available
                             otherwise set to 0 (your laptop screen will be the subject screen)
+            station : name of the testing station. If given, trials are also sent to the collector (see collector.py)
+            collector_host : address of the collector PC (DEFAULT: 'localhost', the collector runs on this PC)
         """
 
-        self.subject_id = subject_id
+        self.subject_id     = subject_id
+        self.station        = station
+        self.collector_host = collector_host
 
         # open up a screen and display fixation
         ## you can set the resolution of the subject screen here: (check screen code)
@@ -85,12 +95,12 @@ class Run():
         feedback_text.draw()
         self.subject_screen.window.flip()
     
-    def init_run(self, debug = False, **kwargs):
+    def init_run(self, debug = False, adaptive = False, **kwargs):
         """
         initializing the run:
         Asking the user to input the run number
         Checking if there is already a file with the behavioural data for the subject
-        Opening the target file for the current run
+        Opening the target file for the current run (not used in the adaptive mode)
         """
 
         # get info from the user
@@ -131,7 +141,13 @@ class Run():
 
         # load the target file
         ## the dataframe is read with index_col = [0] option to avoid the Unnamed: 0 column added to the dataframe
-        self.targetfile_run = pd.read_csv(consts.target_dir/ self.study_name / f"WMC_{self.run_number:02}.csv", index_col=[0])
+        ## in the adaptive mode trials are made during the run instead
+        if adaptive:
+            self.targetfile_run = None
+            self.design = AdaptiveWMChunking(run_number = self.run_number, study_name = self.study_name)
+        else:
+            self.targetfile_run = pd.read_csv(consts.target_dir/ self.study_name / f"WMC_{self.run_number:02}.csv", index_col=[0])
+            self.design = None
    
     def end_run(self):
         """
@@ -157,21 +173,35 @@ class Run():
             self.subject_screen.window.close()
             core.quit()
     
-    def do(self, debug = False):
+    def do(self, debug = False, adaptive = False):
         """
         do a run of the experiment
+        Args:
+            debug : run in the debug mode
+            adaptive : make the trials during the run based on accuracy (see AdaptiveWMChunking in make_target.py)
         """
         print(f"running the experiment")
         
         # initialize the run
-        self.init_run(debug = debug)
+        self.init_run(debug = debug, adaptive = adaptive)
+
+        # connect to the collector if the run is done on one of several stations
+        station_client = None
+        if self.station is not None:
+            station_client = StationClient(station = self.station,
+                                           subject_id = self.subject_id,
+                                           run_number = self.run_number,
+                                           num_trials = 2*self.design.num_trials_total if adaptive else len(self.targetfile_run.index),
+                                           host = self.collector_host)
 
         # create an instance of the task object
         Task_obj = WMChunking(screen = self.subject_screen, 
                               target_file = self.targetfile_run,
                               study_name = 'behavioural', 
                               run_number = self.run_number, 
-                              save_response = False)
+                              save_response = False,
+                              station_client = station_client,
+                              design = self.design)
 
         # run the task
         Task_obj.run()
@@ -191,6 +221,195 @@ class Run():
 
         # end the run
         self.end_run()
+class RunResults():
+    """
+    A buffer for the responses recorded during a run of the task
+    All the arrays are preallocated from the number of trials and the maximum seq_length
+    so nothing is allocated per trial. The dataframe is created only once, at the end of the run
+    Args:
+        num_trials     : number of trials in the run (number of rows in the target file)
+        max_seq_length : maximum number of presses that can be made in a trial
+    """
+    def __init__(self, num_trials, max_seq_length):
+
+        self.num_trials     = num_trials
+        self.max_seq_length = max_seq_length
+
+        # one row for each trial
+        self.TN             = np.zeros(num_trials, dtype = np.int64)
+        self.number_presses = np.zeros(num_trials, dtype = np.int16)
+        self.MT             = np.zeros(num_trials, dtype = np.float64)
+        self.is_error       = np.zeros(num_trials, dtype = bool)
+        self.number_correct = np.zeros(num_trials, dtype = np.int16)
+        self.points         = np.zeros(num_trials, dtype = np.int16)
+
+        # one row for each trial and one column for each press
+        ## keys are names returned by psychopy ('1', '2', ..., 'space', 'backspace')
+        ## the width is increased in add_trial if a longer key name is pressed, so names are never cut
+        self.response       = np.full((num_trials, max_seq_length), '', dtype = 'U16')
+        self.response_time  = np.full((num_trials, max_seq_length), np.nan, dtype = np.float64)
+
+        # one row for each trial and one column for each chunk (encoding trials only)
+        ## a chunk has at least one digit, so there are never more chunks than max_seq_length
+        ## onsets are the flip times of the chunk and of its mask (trial time)
+        ## deviations are the differences between the onsets and their scheduled times
+        self.number_chunks   = np.zeros(num_trials, dtype = np.int16)
+        self.chunk_onset     = np.full((num_trials, max_seq_length), np.nan, dtype = np.float64)
+        self.chunk_deviation = np.full((num_trials, max_seq_length), np.nan, dtype = np.float64)
+        self.mask_onset      = np.full((num_trials, max_seq_length), np.nan, dtype = np.float64)
+        self.mask_deviation  = np.full((num_trials, max_seq_length), np.nan, dtype = np.float64)
+
+        # time spent preparing the next trial during the feedback and ITI
+        ## and how much longer than planned the feedback and ITI lasted
+        self.prepare_dur    = np.zeros(num_trials, dtype = np.float64)
+        self.iti_overrun    = np.zeros(num_trials, dtype = np.float64)
+
+        self.number_trials  = 0 # number of trials recorded so far
+
+    def add_trial(self, trial_index, response, response_time,
+                  movement_time, is_error, number_correct, points,
+                  chunk_onset = (), chunk_deviation = (), mask_onset = (), mask_deviation = ()):
+        """
+        records the responses of a trial in the next row of the buffer
+        Args:
+            trial_index    : index of the trial in the target file
+            response       : list of pressed keys
+            response_time  : list of times of presses
+            movement_time  : time between the first and the last press
+            is_error       : whether at least one wrong press was made
+            number_correct : number of correct presses
+            points         : points the participant got for the trial
+            chunk_onset    : list of onset times of the chunks (encoding trials)
+            chunk_deviation: list of differences between the onset of each chunk and its scheduled onset
+            mask_onset     : list of onset times of the masks (encoding trials)
+            mask_deviation : list of differences between the onset of each mask and its scheduled onset
+        """
+        row = self.number_trials
+        number_presses = len(response)
+        number_chunks  = len(chunk_onset)
+
+        self.TN[row]             = trial_index
+        self.number_presses[row] = number_presses
+        self.MT[row]             = movement_time
+        self.is_error[row]       = is_error
+        self.number_correct[row] = number_correct
+        self.points[row]         = points
+
+        # make room for key names longer than the current width
+        key_length = max([len(key) for key in response], default = 0)
+        if key_length > self.response.dtype.itemsize // 4: # 4 bytes per character
+            self.response = self.response.astype(f"U{key_length}")
+
+        self.response[row, :number_presses]      = response
+        self.response_time[row, :number_presses] = response_time
+
+        self.number_chunks[row]                 = number_chunks
+        self.chunk_onset[row, :number_chunks]     = chunk_onset
+        self.chunk_deviation[row, :number_chunks] = chunk_deviation
+        self.mask_onset[row, :number_chunks]      = mask_onset
+        self.mask_deviation[row, :number_chunks]  = mask_deviation
+
+        self.number_trials += 1
+
+    def set_iti_timing(self, prepare_dur, iti_overrun):
+        """
+        records the timing of the feedback and ITI of the last recorded trial
+        Args:
+            prepare_dur : time spent preparing the next trial
+            iti_overrun : time the feedback and ITI lasted longer than planned
+        """
+        self.prepare_dur[self.number_trials - 1] = prepare_dur
+        self.iti_overrun[self.number_trials - 1] = iti_overrun
+
+    def get_trial_record(self, row, trial_info):
+        """
+        returns the info and the responses of a recorded trial as a dictionary
+        used to send the trial to the collector
+        Args:
+            row         : row of the trial in the buffer
+            trial_info  : info of the trial (its row in the target file)
+        """
+        number_presses = self.number_presses[row]
+
+        record = {'TN': self.TN[row]}
+        record.update(trial_info.to_dict())
+        record['response']       = self.response[row, :number_presses].tolist()
+        record['response_time']  = self.response_time[row, :number_presses].tolist()
+        for column in ['chunk_onset', 'chunk_deviation', 'mask_onset', 'mask_deviation']:
+            record[column] = getattr(self, column)[row, :self.number_chunks[row]].tolist()
+        record['MT']             = self.MT[row]
+        record['is_error']       = self.is_error[row]
+        record['number_correct'] = self.number_correct[row]
+        record['points']         = self.points[row]
+        record['prepare_dur']    = self.prepare_dur[row]
+        record['iti_overrun']    = self.iti_overrun[row]
+
+        return record
+
+    def to_dataframe(self, target_file):
+        """
+        converts the recorded responses to a dataframe
+        the trial info from the target file comes first, followed by the responses
+        Args:
+            target_file : the target file the trials were taken from
+        Returns:
+            response_df (pd.DataFrame) : one row for each recorded trial
+        """
+        n = self.number_trials
+        response_df = target_file.loc[self.TN[:n]].copy()
+
+        # response and response_time are saved as lists (same as the old files)
+        response_df['response']       = [self.response[i, :self.number_presses[i]].tolist() for i in range(n)]
+        response_df['response_time']  = [self.response_time[i, :self.number_presses[i]].tolist() for i in range(n)]
+        for column in ['chunk_onset', 'chunk_deviation', 'mask_onset', 'mask_deviation']:
+            response_df[column] = [getattr(self, column)[i, :self.number_chunks[i]].tolist() for i in range(n)]
+        response_df['MT']             = self.MT[:n]
+        response_df['is_error']       = self.is_error[:n]
+        response_df['number_correct'] = self.number_correct[:n]
+        response_df['points']         = self.points[:n]
+        response_df['prepare_dur']    = self.prepare_dur[:n]
+        response_df['iti_overrun']    = self.iti_overrun[:n]
+
+        # add the trial index as the first column
+        response_df.insert(loc = 0, column='TN', value=self.TN[:n])
+
+        return response_df
+
+    def get_onset_jitter(self):
+        """
+        summarizes how far the onsets of the chunks and of the masks were from their schedule, for each chunk position
+        Returns:
+            jitter_df (pd.DataFrame) : one row for each chunk position with the number of chunks shown and
+                                       the mean, std (jitter) and max of the deviation for chunks and masks
+        """
+        n = self.number_trials
+        # only the positions with at least one chunk
+        positions = np.flatnonzero(np.any(~np.isnan(self.chunk_deviation[:n]), axis = 0))
+
+        jitter_df = pd.DataFrame({'chunk_position' : positions + 1,
+                                  'number_chunks'  : np.sum(~np.isnan(self.chunk_deviation[:n, positions]), axis = 0)})
+        for name in ['chunk', 'mask']:
+            deviation = getattr(self, f"{name}_deviation")[:n, positions]
+            jitter_df[f"{name}_mean_deviation"] = np.nanmean(deviation, axis = 0)
+            jitter_df[f"{name}_jitter"]         = np.nanstd(deviation, axis = 0)
+            jitter_df[f"{name}_max_deviation"]  = np.nanmax(deviation, axis = 0)
+        return jitter_df
+
+    def get_iti_report(self, tolerance = 0.001):
+        """
+        checks that preparing the next trial never made the feedback and ITI longer
+        Args:
+            tolerance : overrun (in seconds) that is not counted as extending the ITI
+        Returns:
+            iti_report (dict) : max time spent preparing the next trial, max overrun and
+                                number of trials where the ITI was extended
+        """
+        n = self.number_trials
+        iti_report = {'max_prepare_dur' : float(np.max(self.prepare_dur[:n], initial = 0)),
+                      'max_iti_overrun' : float(np.max(self.iti_overrun[:n], initial = 0)),
+                      'number_extended' : int(np.sum(self.iti_overrun[:n] > tolerance))}
+        return iti_report
+
 class WMChunking():
     """
     Creates an instance of WMChunking class
@@ -200,9 +419,12 @@ class WMChunking():
         target_file   : the target file containing trial information for a run of the task
         study_name    : either 'behavioural' or 'fmri'
         save_response : whether you want to save the responses into a file
+        station_client: StationClient sending each trial to the collector (None when running on one station)
+        design        : AdaptiveWMChunking making the trials during the run (None to use target_file)
     """
     def __init__(self, screen, target_file, run_number, 
-                 study_name, save_response = True):
+                 study_name, save_response = True, station_client = None,
+                 design = None):
         
         self.screen         = screen
         self.window         = screen.window
@@ -214,32 +436,141 @@ class WMChunking():
         self.trial_response = {} # a dictionary with the responses for all of the trials
         self.run_number     = run_number
         self.run_response   = []
+        self.station_client = station_client
+        self.encoding_frames = {} # frames of the encoding trials prepared ahead of time {trial_index: frames}
+        self.design         = design
+        self.design_trials  = {}  # trials made by the design during the run {trial_index: trial info}
+        self.design_pairs   = []  # pairs of trials made by the design, put together once at the end of the run
 
         # overall points and errors????
 
     # ==================================================
     # helper functions used in main functions for states
-    def _create_chunked_seq(self):
+    def _create_chunked_seq(self, seq_str, chunk):
         """
         creates a chunked version of the sequence to be displayed
-        is used in display_digits routine
+        is used in _make_encoding_frames, the digits shown and the correct presses both come from here
+        Args:
+            seq_str : sequence of digits separated by spaces
+            chunk   : number of digits in a chunk
+        Returns:
+            seq_correct (list)      : the correct presses
+            seq_chunked_list (list) : chunked seq as strings
         """
         # get the digits of the sequence
         ## in the target file they were separated by spaces
-        seq_list = self.seq_str.split(" ")
+        seq_list = seq_str.split(" ")
         # create a variable containing correct presses
         ## this will be used later in the retrieval routine
-        self.seq_correct = seq_list.copy()
+        seq_correct = seq_list.copy()
 
-        self.seq_chunked_list = [] # a list containing chunked seq as strings
-        for i in range(0, len(seq_list), self.chunk):
+        seq_chunked_list = [] # a list containing chunked seq as strings
+        for i in range(0, len(seq_list), chunk):
             # separate the chunk
-            seq_chunked     = seq_list[i:i+self.chunk]
+            seq_chunked     = seq_list[i:i+chunk]
             # put the digits of the chunk together
             seq_chunked_str = ' '.join(seq_chunked)
             # append the chunk to the list
-            self.seq_chunked_list.append(seq_chunked_str)
-        return 
+            seq_chunked_list.append(seq_chunked_str)
+        return seq_correct, seq_chunked_list
+
+    def _make_encoding_frames(self, seq_str, chunk):
+        """
+        creates all the frames shown during the encoding phase of a trial
+        for each chunk: the display with the chunk and the display with the chunk masked
+        each text is drawn once (to the back buffer, which is then cleared) so that
+        the layout and upload of the text is done here and not at the onset of the chunk
+        Args:
+            seq_str : sequence of digits separated by spaces
+            chunk   : number of digits in a chunk
+        Returns:
+            frames (dict) : 'rect_frame', a list of (chunk text, masked text) for each chunk,
+                            'seq_correct' and 'seq_chunked_list' (see _create_chunked_seq)
+        """
+        seq_correct, seq_chunked_list = self._create_chunked_seq(seq_str, chunk)
+
+        rect_frame = visual.rect.Rect(self.window, width = 8, height = 2, 
+                                      lineWidth = 1, lineColor = 'red', 
+                                      pos = [0, 0])
+        rect_frame.draw()
+
+        chunk_frames    = []
+        text_masked_str = '' # text string containing masked digist
+        for seq_chunked_str in seq_chunked_list:
+            text_str        = text_masked_str + seq_chunked_str
+            text_masked_str = text_masked_str + '# '*len(seq_chunked_str.split(" "))
+
+            text_object   = visual.TextStim(self.window, text = text_str, 
+                                            color = 'black', pos = [5, 0], alignText = 'left')
+            masked_object = visual.TextStim(self.window, text = text_masked_str, 
+                                            color = 'black', pos = [5, 0], alignText = 'left')
+            text_object.draw()
+            masked_object.draw()
+            chunk_frames.append((text_object, masked_object))
+
+        # nothing drawn here should ever be shown
+        self.window.clearBuffer()
+
+        return {'rect_frame'       : rect_frame, 
+                'chunk_frames'     : chunk_frames,
+                'seq_correct'      : seq_correct,
+                'seq_chunked_list' : seq_chunked_list}
+
+    def prefetch_encoding(self, trial_index):
+        """
+        prepares the frames of an encoding trial ahead of time
+        is used during the feedback and the ITI of the preceding trial
+        Args:
+            trial_index : index of the trial in the target file
+        """
+        if trial_index is None or trial_index in self.encoding_frames:
+            return
+        trial = self.get_trial(trial_index)
+        if trial['phase_type'] != 0: # only encoding trials display the digits
+            return
+        self.encoding_frames[trial_index] = self._make_encoding_frames(trial['seq_str'], int(trial['chunk']))
+
+    def get_trial(self, trial_index):
+        """
+        gets the info of a trial from the target file (or from the trials made by the design)
+        Args:
+            trial_index : index of the trial in the target file
+        """
+        if self.design is not None:
+            return self.design_trials[trial_index]
+        return self.target_file.loc[trial_index]
+
+    def _add_design_trials(self, trial_df):
+        """
+        adds a pair of trials made by the design to the trials of the run
+        the pairs are kept in a list (not concatenated onto the target file during the run)
+        Args:
+            trial_df : the two trials made by design.next_trial()
+        """
+        self.design_pairs.append(trial_df)
+        for trial_index, trial in trial_df.iterrows():
+            self.design_trials[trial_index] = trial
+            self.trial_indices.append(trial_index)
+
+    def prepare_next_trial(self):
+        """
+        prepares the next trial during the feedback and the ITI of the current trial
+        in the adaptive mode, the next trial is made here based on the accuracy of the current trial
+        the display of the next trial is then prepared (see prefetch_encoding)
+        """
+        t_start = self.get_current_trial_time()
+
+        # make the next pair of trials once the retrieval is done
+        if (self.design is not None and self.next_trial_index is None 
+            and self.phase_type == 1 and self.design.has_next_trial()):
+            self.design.update(is_error = self.is_error)
+            trial_df = self.design.next_trial()
+            self._add_design_trials(trial_df)
+            self.next_trial_index = trial_df.index[0]
+
+        self.prefetch_encoding(self.next_trial_index)
+
+        self.prepare_dur += self.get_current_trial_time() - t_start
     # ==================================================
 
     def init_trial(self):
@@ -256,10 +587,16 @@ class WMChunking():
         self.response_time   = []    # will contain the times of presses
         self.number_response = 0     # will contain the number of presses made. Each time a press is detected, this is incremented
         self.number_correct  = 0     # will be the numbere of correct ore
+        self.chunk_onset     = []    # will contain the onset times of the chunks (encoding)
+        self.chunk_deviation = []    # will contain the differences between the onsets of the chunks and their schedule (encoding)
+        self.mask_onset      = []    # will contain the onset times of the masks (encoding)
+        self.mask_deviation  = []    # will contain the differences between the onsets of the masks and their schedule (encoding)
+        self.prepare_dur     = 0     # will be the time spent preparing the next trial during feedback and ITI
+        self.iti_overrun     = 0     # will be how much longer than planned the feedback and ITI lasted
         # self.movement_time  = []    # will contain the movement time of the trial
 
         # get the current trial
-        self.current_trial = self.target_file.loc[self.trial_index]
+        self.current_trial = self.get_trial(self.trial_index)
 
         # get info for the current trial
         self.item_dur     = self.current_trial['item_dur']
@@ -299,44 +636,51 @@ class WMChunking():
                 - a short delay before the next chunk appears? 
         """
 
-        # Create a rectangle that will enclose the sequence of digits
-        self.rect_frame = visual.rect.Rect(self.window, width = 8, height = 2, 
-                                           lineWidth = 1, lineColor = 'red', 
-                                           pos = [0, 0])
-        # Divide the sequence into chunks
-        ## once this routine is executed, self.seq_chunked_str is created
-        self._create_chunked_seq()
+        # get the frames prepared during the ITI of the previous trial
+        ## they are only made here if they were not prepared ahead of time (first trial)
+        self.prefetch_encoding(self.trial_index)
+        frames = self.encoding_frames.pop(self.trial_index)
+
+        # the chunks shown and the correct presses used in the retrieval routine
+        self.seq_correct      = frames['seq_correct']
+        self.seq_chunked_list = frames['seq_chunked_list']
+
+        # the rectangle that will enclose the sequence of digits
+        self.rect_frame = frames['rect_frame']
+
+        # flip() returns the time of the flip on psychopy's global clock
+        ## the offset converts it to the time in the trial
+        clock_offset = core.getTime() - self.get_current_trial_time()
+        # the first chunk is scheduled for the start of the encoding phase
+        ## every other chunk is scheduled item_dur after the onset of the previous chunk
+        chunk_scheduled = self.get_current_trial_time()
 
         # Loop over chunks
-        self.text_object = []
-        x_pos            = 0
-        chunk_index      = 0
-        text_str         = '' # text string that will be shown
-        text_masked_str  = '' # text string containing masked digist
-        for chunk in self.seq_chunked_list:
+        for text_object, masked_object in frames['chunk_frames']:
             # display the current chunk
-            self.chunkStartTime = self.get_current_trial_time()
-            text_str    = text_masked_str + chunk
-            text_object = visual.TextStim(self.window, text = text_str, 
-                                          color = 'black', pos = [5, 0], alignText = 'left') 
-
             self.rect_frame.draw()
             text_object.draw()
-            self.window.flip(clearBuffer = True)
+            self.chunkStartTime = self.window.flip(clearBuffer = True) - clock_offset
+
+            # record the onset of the chunk
+            self.chunk_onset.append(self.chunkStartTime)
+            self.chunk_deviation.append(self.chunkStartTime - chunk_scheduled)
 
             # keep it on the screen for item_dur
             while self.clock.getTime()-self.chunkStartTime <= (self.item_dur):
                 pass
             
             # Change it to masked 
-            text_masked_str = text_masked_str + '# '*int(self.chunk)
-            text_object = visual.TextStim(self.window, text = text_masked_str, 
-                                          color = 'black', pos = [5, 0], alignText = 'left')
             self.rect_frame.draw() 
-            text_object.draw()
-            self.window.flip(clearBuffer = True)
+            masked_object.draw()
+            self.chunkEndTime = self.window.flip(clearBuffer = True) - clock_offset
+
+            # record the onset of the mask (scheduled item_dur after the onset of the chunk)
+            self.mask_onset.append(self.chunkEndTime)
+            self.mask_deviation.append(self.chunkEndTime - (self.chunkStartTime + self.item_dur))
+            chunk_scheduled = self.chunkStartTime + self.item_dur
+
             # a short delay
-            self.chunkEndTime = self.get_current_trial_time()
             # while self.clock.getTime()-self.chunkEndTime <= (0.5):
             #     pass
 
@@ -456,32 +800,63 @@ class WMChunking():
         self.window.flip(clearBuffer = True)
 
         feedback_startTime = self.get_current_trial_time() # get the time before iti starts
+
+        # use the feedback time to prepare the next trial
+        self.prepare_next_trial()
+
         while self.clock.getTime()-feedback_startTime <= self.iti_dur:
             # stays here for the duration of the feedback_dur
             pass
+        self.iti_overrun += max(self.clock.getTime()-feedback_startTime - self.iti_dur, 0)
     
     def wait_iti(self):
         """
         waits here for the duration of iti
         """
         iti_startTime = self.get_current_trial_time() # get the time before iti starts
+
+        # use the iti to prepare the next trial (if not already done during feedback)
+        self.prepare_next_trial()
+
         while self.clock.getTime()-iti_startTime <= self.feedback_dur:
             # stays here for the duration of the iti
             pass
+        self.iti_overrun += max(self.clock.getTime()-iti_startTime - self.feedback_dur, 0)
 
     def run(self):
         """
         runs the task
-        get the trials from target file and loop over trials
+        get the trials from target file (or from the adaptive design) and loop over trials
         """
-        # initialize a list to collect responses from all trials
-        self.all_trial_response = []
-        self.response_df = pd.DataFrame()
+        # initialize a buffer to collect responses from all trials
+        ## the buffer is converted to a dataframe once all the trials are done
+        if self.design is not None:
+            # start with the first pair of trials, the others are made during the run
+            self.trial_indices = []
+            self._add_design_trials(self.design.next_trial())
+            self.run_results = RunResults(num_trials = 2*self.design.num_trials_total,
+                                          max_seq_length = self.design.max_seq_length)
+        else:
+            self.trial_indices = list(self.target_file.index)
+            self.run_results = RunResults(num_trials = len(self.target_file.index),
+                                          max_seq_length = int(self.target_file['seq_length'].max()))
+
+        # prepare the display of the first trial
+        self.prefetch_encoding(self.trial_indices[0])
 
         # loop over trials
-        for self.trial_index in self.target_file.index:
+        ## the list of trials can grow during the run (adaptive mode)
+        trial_position = 0
+        while trial_position < len(self.trial_indices):
+            self.trial_index = self.trial_indices[trial_position]
             
             print(f"trial number {self.trial_index}")
+            # the next trial is prepared during the feedback and ITI of this trial
+            if trial_position + 1 < len(self.trial_indices):
+                self.next_trial_index = self.trial_indices[trial_position + 1]
+            else:
+                self.next_trial_index = None
+
             # get info for the current trial
             self.init_trial()
 
@@ -495,21 +870,18 @@ class WMChunking():
                 # calculate movement time: time beteween first and last press
                 movement_time = self.response_time[-1] - self.response_time[0]
 
-            # append the recorded responses to the datafarme for the trial
-            self.trial_response = self.current_trial.to_frame().T
-            print(self.trial_response)
-
-            self.trial_response['response']       = [self.response]
-            self.trial_response['response_time']  = [self.response_time]
-            self.trial_response['MT']             = movement_time
-            self.trial_response['is_error']       = self.is_error
-            self.trial_response['number_correct'] = self.number_correct
-            self.trial_response['points']         = self.trial_points
-
-            # add the trial index as the first column
-            self.trial_response.insert(loc = 0, column='TN', value=self.trial_index)
-            
-            self.response_df = pd.concat([self.response_df, self.trial_response])
+            # record the responses of the trial in the buffer
+            self.run_results.add_trial(trial_index    = self.trial_index,
+                                       response       = self.response,
+                                       response_time  = self.response_time,
+                                       movement_time  = movement_time,
+                                       is_error       = self.is_error,
+                                       number_correct = self.number_correct,
+                                       points         = self.trial_points,
+                                       chunk_onset    = self.chunk_onset,
+                                       chunk_deviation= self.chunk_deviation,
+                                       mask_onset     = self.mask_onset,
+                                       mask_deviation = self.mask_deviation)
 
             # STATE: show feedback
             if self.display_trial_feedback:
@@ -519,7 +891,149 @@ class WMChunking():
             # STATE: ITI
             self.wait_iti()
 
+            # record how the feedback and ITI were used
+            self.run_results.set_iti_timing(self.prepare_dur, self.iti_overrun)
+
+            # send the trial to the collector (with the same columns as the station's own file)
+            ## the trial is only put in a queue, a separate thread sends it
+            if self.station_client is not None:
+                self.station_client.send_trial(self.run_results.get_trial_record(self.run_results.number_trials - 1, 
+                                                                                 self.current_trial))
+
+            trial_position += 1
+
+        # the trials made by the design are put together only once, at the end of the run
+        if self.design is not None:
+            self.target_file = pd.concat(self.design_pairs)
+
+        # convert the responses of all the trials to a dataframe
+        self.response_df = self.run_results.to_dataframe(self.target_file)
+
+        # report the onset jitter of the chunks
+        self.onset_jitter = self.run_results.get_onset_jitter()
+        print(self.onset_jitter)
+
+        # report whether preparing the next trial extended the ITI
+        self.iti_report = self.run_results.get_iti_report()
+        print(self.iti_report)
+
+        if self.station_client is not None:
+            self.station_client.close()
+
+def benchmark_run_results(num_trials_list = [100, 200, 400, 800], seq_length = 6):
+    """
+    measures the memory used to collect the responses of a run into a dataframe with RunResults
+    (including the final to_dataframe) and with the old way (one dataframe per trial concatenated onto the responses)
+    the memory per trial should stay flat for RunResults as the number of trials grows
+    Args:
+        num_trials_list : numbers of trials in the simulated runs
+        seq_length      : number of presses in each trial
+    Returns:
+        benchmark_df (pd.DataFrame) : one row for each number of trials with bytes per trial
+                                      (memory kept and peak memory) and time for both ways
+    """
+    rows = []
+    for num_trials in num_trials_list:
+        # a simulated target file (same columns as the ones made by make_target.py)
+        target_file = pd.DataFrame({'hand'       : 'right',
+                                    'item_dur'   : 2,
+                                    'iti_dur'    : 1,
+                                    'run_number' : 1,
+                                    'phase_type' : np.arange(num_trials) % 2,
+                                    'seq_length' : seq_length,
+                                    'chunk'      : 3,
+                                    'recall_dir' : 1,
+                                    'seq_str'    : ' '.join(['1']*seq_length)})
+        response      = [str(i % 4 + 1) for i in range(seq_length)]
+        response_time = [0.2*i for i in range(seq_length)]
+
+        # RunResults
+        ## converted to a dataframe at the end, so both ways end with the same dataframe
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        run_results = RunResults(num_trials = num_trials, max_seq_length = seq_length)
+        for trial_index in target_file.index:
+            run_results.add_trial(trial_index, response, response_time, 1.0, False, seq_length, 10)
+        buffer_df = run_results.to_dataframe(target_file)
+        buffer_dur = time.perf_counter() - t_start
+        buffer_current, buffer_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del run_results, buffer_df
+
+        # the old way: one dataframe per trial concatenated onto response_df
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        response_df = pd.DataFrame()
+        for trial_index in target_file.index:
+            trial_response = target_file.loc[trial_index].to_frame().T
+            trial_response['response']       = [list(response)]
+            trial_response['response_time']  = [list(response_time)]
+            trial_response['MT']             = 1.0
+            trial_response['is_error']       = False
+            trial_response['number_correct'] = seq_length
+            trial_response['points']         = 10
+            trial_response.insert(loc = 0, column='TN', value=trial_index)
+            response_df = pd.concat([response_df, trial_response])
+        concat_dur = time.perf_counter() - t_start
+        concat_current, concat_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del response_df
+
+        rows.append({'num_trials'            : num_trials,
+                     'buffer_bytes_per_trial': buffer_current / num_trials,
+                     'buffer_peak_per_trial' : buffer_peak / num_trials,
+                     'buffer_dur'            : buffer_dur,
+                     'concat_bytes_per_trial': concat_current / num_trials,
+                     'concat_peak_per_trial' : concat_peak / num_trials,
+                     'concat_dur'            : concat_dur})
+
+    benchmark_df = pd.DataFrame(rows)
+    print(benchmark_df)
+    return benchmark_df
+
+def benchmark_prepare_next_trial(num_trials = 100, screen_number = 0, **kwargs):
+    """
+    measures the time it takes to prepare the next trial in the adaptive mode
+    (making the trial with the design and rendering its encoding frames, see prepare_next_trial)
+    and compares it to the feedback window it is done in: show_trial_feedback waits iti_dur
+    after a retrieval, and any time beyond that window is not absorbed by wait_iti
+    Args:
+        num_trials    : number of trials prepared
+        screen_number : number of the screen the frames are rendered on
+        other arguments are passed on to AdaptiveWMChunking
+    Returns:
+        result (dict) : mean and max time to prepare a trial, the time available (in seconds)
+                        and whether preparing a trial would extend the ITI
+    """
+    screen = Screen(screen_number = screen_number)
+    design = AdaptiveWMChunking(num_trials = num_trials, **kwargs)
+    task   = WMChunking(screen = screen, target_file = None, run_number = 1, 
+                        study_name = 'behavioural', save_response = False, design = design)
+
+    task.trial_indices = []
+    task._add_design_trials(design.next_trial())
+
+    # prepare the trials the way it is done after each retrieval
+    durations = []
+    task.phase_type = 1
+    while design.has_next_trial():
+        task.next_trial_index = None
+        task.is_error    = random.random() < 0.3
+        task.prepare_dur = 0
+        task.prepare_next_trial()
+        durations.append(task.prepare_dur)
+        task.encoding_frames.clear()
+    screen.window.close()
+
+    # after a retrieval, the next trial is prepared during the feedback (show_trial_feedback waits iti_dur)
+    time_available = design.iti_dur[1]
+    result = {'mean_dur': float(np.mean(durations)), 'max_dur': float(np.max(durations)), 
+              'time_available': time_available,
+              'extends_iti': bool(np.max(durations) > time_available)}
+    print(result)
+    return result
+
 # do a run of the experiment
-def main(subject_id, debug = False):
-    Run_Block = Run(subject_id = subject_id)
-    Run_Block.do(debug = debug)
\ No newline at end of file
+def main(subject_id, debug = False, adaptive = False, station = None, collector_host = 'localhost'):
+    Run_Block = Run(subject_id = subject_id, station = station, collector_host = collector_host)
+    Run_Block.do(debug = debug, adaptive = adaptive)
\ No newline at end of file
@@ -3,6 +3,7 @@
 import pandas as pd
 import numpy as np
 import random
+import time
 from itertools import product
 import constants as consts
 
@@ -84,50 +85,61 @@ class WMChunking():
         self.trials = random.sample(list(self.trials_unique), self.num_trials_total)
 
         for trial_number in range(len(self.trials)):
-            # initialize a dictionary with the trial info as keys
-            # NOTE: we have pairs of trials: "encoding" followed by "retrieval"
-            # info for a pair is added simoultaneously
-            self.trial_dict = {}
-
-            self.trial_dict['hand'] = [self.hand for i in range(2)]
-            self.trial_dict['item_dur'] = [self.item_dur for i in range(2)]
-            self.trial_dict['iti_dur'] = self.iti_dur
-            self.trial_dict['run_number'] = self.run_number
-            self.trial_dict['phase_type'] = [0, 1]
-            self.trial_dict['phase'] = ['enc', 'ret'] # enc for encoding and ret for retrieval
-            self.trial_dict['display_trial_feedback'] = [False, True]
-            self.trial_dict['feedback_dur'] = self.feedback_dur
-            self.trial_dict['feedback_type'] = ['None', 'acc']
-            self.trial_dict['seq_length'] = [self.seq_length for i in range(2)]
-
             # get the type of the current trial
             trial_type_id = self.trials[trial_number]
             ## now use the trial_type_id to get the trial_type (chunk and recall_dir) from the dictionary
             trial_type = self.seq_dict_list[trial_type_id-1] # 1 is subtracted because indices in python start from 0
-            # add the info to the dictionary
-            self.trial_dict['chunk'] = [trial_type['chunk'] for i in range(2)]
-            self.trial_dict['recall_dir'] = [trial_type['recall_dir'] for i in range(2)]
-            
-            # calculate trial duration
-            trial_dur = trial_type['chunk'] * self.item_dur
-            self.trial_dict['trial_dur'] = [trial_dur, 'None']
-
-            # generate a sequence of random numbers
-            ## once the following routine is executed, self.seq_list, self.seq_str are created
-            self.generate_random_seq()
-            ## add self.seq_str to the trial dictionary
-            self.trial_dict['seq_str'] = []
-            self.trial_dict['seq_str'].append(self.seq_str) # for the encoding phase
-
-            # generate a sequence masked
-            self.generate_masked_seq()
-            self.trial_dict['seq_str'].append(self.seq_masked) # for the retrieval phase
 
             # add the info to the target dataframe
-            trial_df = pd.DataFrame(self.trial_dict)
+            trial_df = self.make_trial_pair(trial_type)
             self.target_df = self.target_df.append(trial_df, ignore_index=True)
         return
 
+    def make_trial_pair(self, trial_type):
+        """
+        makes a pair of trials: "encoding" followed by "retrieval"
+        Args:
+            trial_type : dictionary with the chunk and recall_dir of the trial
+        Returns:
+            trial_df (pd.DataFrame) : dataframe with the two trials
+        """
+        # initialize a dictionary with the trial info as keys
+        # NOTE: we have pairs of trials: "encoding" followed by "retrieval"
+        # info for a pair is added simoultaneously
+        self.trial_dict = {}
+
+        self.trial_dict['hand'] = [self.hand for i in range(2)]
+        self.trial_dict['item_dur'] = [self.item_dur for i in range(2)]
+        self.trial_dict['iti_dur'] = self.iti_dur
+        self.trial_dict['run_number'] = self.run_number
+        self.trial_dict['phase_type'] = [0, 1]
+        self.trial_dict['phase'] = ['enc', 'ret'] # enc for encoding and ret for retrieval
+        self.trial_dict['display_trial_feedback'] = [False, True]
+        self.trial_dict['feedback_dur'] = self.feedback_dur
+        self.trial_dict['feedback_type'] = ['None', 'acc']
+        self.trial_dict['seq_length'] = [self.seq_length for i in range(2)]
+
+        # add the info to the dictionary
+        self.trial_dict['chunk'] = [trial_type['chunk'] for i in range(2)]
+        self.trial_dict['recall_dir'] = [trial_type['recall_dir'] for i in range(2)]
+        
+        # calculate trial duration
+        trial_dur = trial_type['chunk'] * self.item_dur
+        self.trial_dict['trial_dur'] = [trial_dur, 'None']
+
+        # generate a sequence of random numbers
+        ## once the following routine is executed, self.seq_list, self.seq_str are created
+        self.generate_random_seq()
+        ## add self.seq_str to the trial dictionary
+        self.trial_dict['seq_str'] = []
+        self.trial_dict['seq_str'].append(self.seq_str) # for the encoding phase
+
+        # generate a sequence masked
+        self.generate_masked_seq()
+        self.trial_dict['seq_str'].append(self.seq_masked) # for the retrieval phase
+
+        return pd.DataFrame(self.trial_dict)
+
     def save_target_file(self):
         """
         save the target file in the corresponding directory
@@ -135,6 +147,101 @@ class WMChunking():
         consts.dircheck(self.target_dir)
         self.target_df.to_csv(self.target_filedir)
 
+class AdaptiveWMChunking(WMChunking):
+
+    def __init__(self, num_trials = 20, seq_length = 6, min_seq_length = 4, 
+                 max_seq_length = 9, num_down = 2, **kwargs):
+        """
+        class for the adaptive design: trials are made one at a time during the run
+        instead of being read from a target file.
+        seq_length follows a staircase: it goes up by one after num_down correct trials in a row
+        and down by one after an error. The chunk/recall_dir mix stays balanced (shuffled in blocks)
+        Args:
+            num_trials : number of (encoding + retrieval) trials in the run
+            seq_length : length of the sequence at the start of the run (DEFAULT: 6)
+            min_seq_length : shortest sequence the staircase can go to (DEFAULT: 4)
+            max_seq_length : longest sequence the staircase can go to (DEFAULT: 9)
+            num_down : number of correct trials in a row before the sequence gets longer (DEFAULT: 2)
+            other arguments are passed on to WMChunking (iti_dur, item_dur, run_number, ...)
+        """
+        super().__init__(seq_length = seq_length, **kwargs)
+
+        self.num_trials_total = num_trials
+        self.min_seq_length = min_seq_length
+        self.max_seq_length = max_seq_length
+        self.num_down = num_down
+
+        self.num_correct_row = 0 # number of correct trials in a row
+        self.trial_number = 0    # number of trials made so far
+        self.trial_types = []    # shuffled block of trial types the next trials are taken from
+
+    def update(self, is_error):
+        """
+        updates seq_length based on the accuracy of the last retrieval trial
+        Args:
+            is_error : whether at least one wrong press was made in the trial
+        """
+        if is_error:
+            self.num_correct_row = 0
+            self.seq_length = max(self.seq_length - 1, self.min_seq_length)
+        else:
+            self.num_correct_row += 1
+            if self.num_correct_row == self.num_down:
+                self.num_correct_row = 0
+                self.seq_length = min(self.seq_length + 1, self.max_seq_length)
+
+    def has_next_trial(self):
+        """
+        checks if there are trials left to be made
+        """
+        return self.trial_number < self.num_trials_total
+
+    def next_trial(self):
+        """
+        makes the next pair of trials with the current seq_length
+        Returns:
+            trial_df (pd.DataFrame) : the two trials, indexed after the trials already made
+        """
+        # take a new shuffled block of trial types once the previous one is used
+        if len(self.trial_types) == 0:
+            self.trial_types = random.sample(self.seq_dict_list, len(self.seq_dict_list))
+        trial_type = self.trial_types.pop()
+
+        trial_df = self.make_trial_pair(trial_type)
+        trial_df.index = [2*self.trial_number, 2*self.trial_number + 1]
+        self.trial_number += 1
+        return trial_df
+
+def benchmark_next_trial(num_trials = 1000, **kwargs):
+    """
+    measures the time it takes the adaptive design to make the next trial
+    and compares it to the feedback window it is made in (show_trial_feedback waits iti_dur after a retrieval)
+    NOTE: this only covers making the trial. Rendering its encoding frames is also done in that window,
+    use benchmark_prepare_next_trial in experiment_block.py to time the full step
+    Args:
+        num_trials : number of trials made
+        other arguments are passed on to AdaptiveWMChunking
+    Returns:
+        result (dict) : mean and max time to make a trial, the time available (in seconds)
+                        and whether making a trial would extend the ITI
+    """
+    design = AdaptiveWMChunking(num_trials = num_trials, **kwargs)
+    durations = []
+    while design.has_next_trial():
+        t_start = time.perf_counter()
+        design.update(is_error = random.random() < 0.3)
+        design.next_trial()
+        durations.append(time.perf_counter() - t_start)
+
+    # after a retrieval, the next trial is made during its feedback (show_trial_feedback waits iti_dur)
+    ## time beyond that window is not absorbed by wait_iti, which starts its own timer
+    time_available = design.iti_dur[1]
+    result = {'mean_dur': float(np.mean(durations)), 'max_dur': float(np.max(durations)), 
+              'time_available': time_available,
+              'extends_iti': bool(np.max(durations) > time_available)}
+    print(result)
+    return result
+
 def make_files(number_of_runs = 8):
     """
     make target files for each run
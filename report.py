@@ -0,0 +1,256 @@
+# Builds the figures and summary tables for all the subjects
+# Subjects are rendered in parallel and only re-rendered when their data or this code changes
+# @ use build_reports() to (re)build the reports of the whole cohort
+
+# import libraries
+import os
+import json
+import hashlib
+import datetime
+from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # figures are only saved, never shown
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+import constants as consts
+
+def get_clean_files(study_name = 'behavioural'):
+    """
+    finds the cleaned table of each subject
+    cleaned tables are saved as <subject>_clean.csv or WMC_<subject>_clean.csv in the subject folder
+    Returns:
+        clean_files (dict) : {subject: path to the cleaned table}
+    """
+    behav_dir = consts.raw_dir / study_name / 'raw'
+    clean_files = {}
+    for subj_dir in sorted(behav_dir.iterdir()):
+        if not subj_dir.is_dir():
+            continue
+        subject = subj_dir.name
+        for filename in [f"{subject}_clean.csv", f"WMC_{subject}_clean.csv"]:
+            if (subj_dir / filename).is_file():
+                clean_files[subject] = subj_dir / filename
+                break
+    return clean_files
+
+def get_hash(filepath, code_hash = ''):
+    """
+    hash of a file and the plotting code: if either of them changes, the report is rebuilt
+    """
+    file_hash = hashlib.sha1()
+    file_hash.update(code_hash.encode())
+    with open(filepath, 'rb') as f:
+        file_hash.update(f.read())
+    return file_hash.hexdigest()
+
+def load_clean(filepath):
+    """
+    loads the cleaned table of a subject and gets the data of the retrieval trials
+    Returns:
+        data_exe (pd.DataFrame) : retrieval trials with one column for each inter press interval (ipi_1, ...)
+    """
+    df = pd.read_csv(filepath, converters = {'response_time': literal_eval})
+
+    # get execution trials
+    data_exe = df.loc[df['phase_type'] == 1].copy()
+    data_exe.reset_index(drop = True, inplace = True)
+
+    # calculate ipis for each trial
+    ## trials with missing presses get nan for the ipis that were not made
+    num_ipi = int(data_exe['seq_length'].max()) - 1
+    ipis = np.full((len(data_exe.index), num_ipi), np.nan)
+    for t, response_time in enumerate(data_exe['response_time']):
+        ipi = np.diff(response_time)[:num_ipi]
+        ipis[t, :len(ipi)] = ipi
+    for i in range(num_ipi):
+        data_exe[f"ipi_{i+1}"] = ipis[:, i]
+
+    return data_exe
+
+def calc_summary(data_exe):
+    """
+    summary table of the retrieval trials for each chunk and recall direction
+    """
+    summary_df = data_exe.groupby(['chunk', 'recall_dir']).agg(num_trials     = ('is_error', 'size'),
+                                                              percent_correct = ('is_error', lambda x: (1 - x.mean())*100),
+                                                              number_correct  = ('number_correct', 'mean'),
+                                                              MT              = ('MT', 'mean'),
+                                                              points          = ('points', 'mean'))
+    return summary_df.reset_index()
+
+def calc_ipi(data_exe):
+    """
+    the ipis in long format (one row for each ipi), used for plotting
+    """
+    ipi_cols = [col for col in data_exe.columns if col.startswith('ipi_')]
+    data_ipi = pd.melt(data_exe, id_vars = ['chunk', 'recall_dir'], value_vars = ipi_cols)
+    data_ipi = data_ipi.rename(columns = {'variable': 'ipi', 'value': 'time'})
+    return data_ipi
+
+def plot_ipi(data_ipi, title, filepath):
+    """
+    plots the ipis for each chunk and recall direction
+    """
+    fig, ax = plt.subplots(figsize = (6, 4))
+    sns.lineplot(data = data_ipi, hue = "chunk", x = "ipi", y = "time", style = "recall_dir", palette = 'tab10', ax = ax)
+    ax.set_title(title)
+    fig.savefig(filepath)
+    plt.close(fig)
+
+def plot_runs(data_exe, title, filepath):
+    """
+    plots % correct and movement time across runs
+    """
+    fig, axes = plt.subplots(1, 2, figsize = (10, 4))
+    data_exe = data_exe.assign(percent_correct = (1 - data_exe['is_error'].astype(float))*100)
+    sns.pointplot(data = data_exe, x = "run_number", y = "percent_correct", hue = "chunk", palette = 'tab10', ax = axes[0])
+    sns.pointplot(data = data_exe, x = "run_number", y = "MT", hue = "chunk", palette = 'tab10', ax = axes[1])
+    fig.suptitle(title)
+    fig.savefig(filepath)
+    plt.close(fig)
+
+def build_subject(subject, filepath, subject_report_dir):
+    """
+    renders the figures and the summary table of a subject
+    runs in a worker process
+    Returns:
+        outputs (list) : paths to the files created for the subject
+    """
+    os.makedirs(subject_report_dir, exist_ok = True)
+    data_exe = load_clean(filepath)
+
+    outputs = [subject_report_dir / f"{subject}_plot1.pdf",
+               subject_report_dir / f"{subject}_plot2.pdf",
+               subject_report_dir / f"{subject}_summary.csv"]
+
+    plot_ipi(calc_ipi(data_exe), subject, outputs[0])
+    plot_runs(data_exe, subject, outputs[1])
+    calc_summary(data_exe).to_csv(outputs[2], index = False)
+
+    return [str(output) for output in outputs]
+
+def build_cohort(clean_files, cohort_report_dir):
+    """
+    renders the figures and the summary table of the whole cohort
+    Returns:
+        outputs (list) : paths to the files created for the cohort
+    """
+    os.makedirs(cohort_report_dir, exist_ok = True)
+
+    data_list = []
+    for subject, filepath in clean_files.items():
+        data_exe = load_clean(filepath)
+        data_exe['subject'] = subject
+        data_list.append(data_exe)
+    data_cohort = pd.concat(data_list, axis = 0, ignore_index = True)
+
+    outputs = [cohort_report_dir / "cohort_plot1.pdf",
+               cohort_report_dir / "cohort_plot2.pdf",
+               cohort_report_dir / "cohort_summary.csv"]
+
+    plot_ipi(calc_ipi(data_cohort), 'cohort', outputs[0])
+    plot_runs(data_cohort, 'cohort', outputs[1])
+
+    # summary of each subject
+    summary_df = pd.concat([calc_summary(data_subject).assign(subject = subject)
+                            for subject, data_subject in data_cohort.groupby('subject')], ignore_index = True)
+    summary_df.to_csv(outputs[2], index = False)
+
+    return [str(output) for output in outputs]
+
+def build_reports(study_name = 'behavioural', max_workers = None, force = False):
+    """
+    builds the reports of all the subjects and the cohort
+    a subject is only re-rendered if its cleaned table or this code changed since the last build (or it failed)
+    Args:
+        study_name  : either 'behavioural' or 'fmri'
+        max_workers : number of processes used (DEFAULT: number of cpus)
+        force       : rebuild all the reports
+    Returns:
+        index_df (pd.DataFrame) : index of all the reports (also saved as index.csv in consts.report_dir / study_name)
+    """
+    report_dir = consts.report_dir / study_name
+    consts.dircheck(report_dir)
+
+    # hashes from the last build
+    manifest_file = report_dir / 'manifest.json'
+    manifest = {}
+    if manifest_file.is_file() and not force:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    # the plotting code is part of the hash
+    with open(__file__, 'rb') as f:
+        code_hash = hashlib.sha1(f.read()).hexdigest()
+
+    clean_files = get_clean_files(study_name)
+    hashes = {subject: get_hash(filepath, code_hash) for subject, filepath in clean_files.items()}
+
+    # subjects with new data or changed code (or that failed last time)
+    to_build = [subject for subject in clean_files
+                if manifest.get(subject, {}).get('hash') != hashes[subject]
+                or manifest[subject].get('error') is not None
+                or not all(os.path.isfile(output) for output in manifest[subject]['outputs'])]
+    print(f"rebuilding {len(to_build)} of {len(clean_files)} subjects")
+
+    if len(to_build) > 0:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            futures = {subject: executor.submit(build_subject, subject, clean_files[subject], report_dir / subject)
+                       for subject in to_build}
+            for subject, future in futures.items():
+                manifest[subject] = {'hash'      : hashes[subject],
+                                     'input'     : str(clean_files[subject]),
+                                     'outputs'   : [],
+                                     'error'     : None,
+                                     'built_at'  : datetime.datetime.now().isoformat(timespec = 'seconds')}
+                # a subject that fails does not stop the others
+                ## it is tried again with the next build
+                try:
+                    manifest[subject]['outputs'] = future.result()
+                except Exception as e:
+                    manifest[subject]['error'] = f"{type(e).__name__}: {e}"
+                    print(f"failed to build {subject}: {manifest[subject]['error']}")
+
+    # the cohort is made of the subjects that were built
+    built_files = {subject: filepath for subject, filepath in clean_files.items()
+                   if manifest[subject].get('error') is None}
+
+    # the cohort is rebuilt if any of the subjects changed (or a subject was removed)
+    cohort_hash = hashlib.sha1(''.join(sorted(hashes[subject] for subject in built_files)).encode()).hexdigest()
+    cohort = manifest.get('cohort', {})
+    if (len(built_files) > 0 and
+        (cohort.get('hash') != cohort_hash or cohort.get('error') is not None
+         or not all(os.path.isfile(output) for output in cohort['outputs']))):
+        manifest['cohort'] = {'hash'      : cohort_hash,
+                              'input'     : str(consts.raw_dir / study_name / 'raw'),
+                              'outputs'   : [],
+                              'error'     : None,
+                              'built_at'  : datetime.datetime.now().isoformat(timespec = 'seconds')}
+        try:
+            manifest['cohort']['outputs'] = build_cohort(built_files, report_dir / 'cohort')
+        except Exception as e:
+            manifest['cohort']['error'] = f"{type(e).__name__}: {e}"
+            print(f"failed to build the cohort: {manifest['cohort']['error']}")
+
+    # remove the subjects that no longer have a cleaned table
+    manifest = {key: value for key, value in manifest.items() if key in clean_files or key == 'cohort'}
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent = 2)
+
+    # one row for each report file (and one row for each report that failed)
+    index_rows = []
+    for key, value in manifest.items():
+        if value.get('error') is not None:
+            index_rows.append({'report': key, 'file': None, 'input': value['input'], 
+                               'built_at': value['built_at'], 'error': value['error']})
+        for output in value['outputs']:
+            index_rows.append({'report': key, 'file': output, 'input': value['input'], 
+                               'built_at': value['built_at'], 'error': None})
+    index_df = pd.DataFrame(index_rows)
+    index_df.to_csv(report_dir / 'index.csv', index = False)
+
+    return index_df